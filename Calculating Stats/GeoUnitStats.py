@@ -22,7 +22,15 @@ The program performs the following tasks:
 	6. Calculate building coverage ratio (BCR) for CT, DB and GRID
 	7. Calculate building proximity (ProxMean) for CT, DB and GRID
 	8. Calculate building contiguity (ContRatio) for CT, DB and GRID
+	   Steps 4-8 either count only the buildings contained in each zone (default)
+	   or split buildings straddling zone borders by intersection area (APPORTION = True)
 	9. Load the final outputs into QGIS  
+
+Each task is declared as one or more stages with their input and output files.
+A stage runs as soon as the stages producing its inputs are completed, so the
+CT, DB and GRID branches (and steps 4-6, which do not need NNJoin) run
+concurrently on a pool of WORKERS threads. Completed stages are recorded in
+TEMP, and a new run after a failure resumes from the first incomplete stages.
 	
 Output data: three shapefiles
 	1. Building statistics of the input census tracts (CT)
@@ -44,8 +52,20 @@ The program must be executed in "QGIS Desktop" Python Console.
 '''
 
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from qgis.core import *
 import processing
+from processing.core.ProcessingConfig import ProcessingConfig
+import numpy as np
+from qgis.PyQt.QtCore import QVariant
+try:
+    import shapely
+    #The vectorized apportionment (APPORTION) needs the array API of shapely 2
+    HAS_SHAPELY2 = int(shapely.__version__.split('.')[0]) >= 2
+except ImportError:
+    HAS_SHAPELY2 = False
 from qgis.utils import plugins
 
 ###########################################
@@ -70,368 +90,512 @@ TEMP = "C:\\Fred_NB\\TempOutputs"
 #It's recommended but not required to empty this folder before running the code.
 FO = "C:\\Fred_NB\\FinalOutputs"
 
+#Building apportionment mode.
+#False: a building is counted in a CT/DB/GRID only if the zone contains it, so buildings straddling zone borders are dropped.
+#True: a building straddling zone borders is split among the zones by intersection area,
+#and its area, count, proximity and contiguity are allocated to each zone by the same fraction.
+APPORTION = False
+
+#Number of worker threads running independent stages at the same time.
+#Set it to 1 to run all stages one after another on the main thread (including NNJoin).
+WORKERS = 4
+
+#Resume from the last completed stages of a previous run that failed or was interrupted.
+#The completed stages are discarded when BF, CT, DB or APPORTION have changed since that run.
+RESUME = True
+
 #Manually install the plugin NNJoin in QGIS
     #Plugins --> Manage and Install Plugins --> search for NNjoin and install
     
 
 ###########################################
-#Load data and generate 1 km2 grid
+#Processing helpers
 ###########################################
-#Remove all current layers
-QgsProject.instance().clear()
 
-#Open and display a vector layer
-    #iface.addVectorLayer(data_source, layer_name, provider_name)
-layerCT = iface.addVectorLayer(CT, 'CensusTract','ogr')
-layerDB = iface.addVectorLayer(DB, 'DissemninationBlock','ogr')
-layerBF = iface.addVectorLayer(BF, 'BuildingFootprints','ogr')
+def tmp(name):
+    #Path of a temporary shapefile
+    return TEMP+'\\'+name+'.shp'
+
+def run(algorithm, parameters):
+    #Each call gets its own context and feedback so that stages can run on worker threads.
+    #The context gets the current project and the invalid geometry setting, as processing.run does by default,
+    #but its expression context is built without iface.mapCanvas(), which must only be used on the main thread.
+    feedback = QgsProcessingFeedback()
+    context = QgsProcessingContext()
+    context.setProject(QgsProject.instance())
+    context.setInvalidGeometryCheck(ProcessingConfig.getSetting(ProcessingConfig.FILTER_INVALID_GEOMETRIES))
+    expressionContext = QgsExpressionContext()
+    expressionContext.appendScope(QgsExpressionContextUtils.globalScope())
+    expressionContext.appendScope(QgsExpressionContextUtils.projectScope(QgsProject.instance()))
+    context.setExpressionContext(expressionContext)
+    return processing.run(algorithm, parameters, feedback=feedback, context=context)
+
+def renameLastField(shp, newName):
+    #Load the shapefile as a layer and rename the last field
+        #renameAttribute(self, index: int, newName: str)
+    TempLayer = QgsVectorLayer(shp, 'TempLayer', 'ogr')
+    idx = max(TempLayer.attributeList())  #the index of the field to be renamed
+    with edit(TempLayer):
+        TempLayer.renameAttribute(idx, newName)
+
+def summarize(inp, join, field, summary, discard, out, newName):
+    #Summarize a field of the buildings contained in each zone and name the result newName
+    run("qgis:joinbylocationsummary", 
+        {'INPUT':inp,'JOIN':join,
+        'PREDICATE':[1],'JOIN_FIELDS':[field],'SUMMARIES':[summary],'DISCARD_NONMATCHING':discard,
+        'OUTPUT':out})
+    renameLastField(out, newName)
+
+def calculate(inp, fieldName, formula, out):
+    run("qgis:fieldcalculator", 
+        {'INPUT':inp,
+        'FIELD_NAME':fieldName,'FIELD_TYPE':0,'FIELD_LENGTH':12,'FIELD_PRECISION':8,'NEW_FIELD':True,
+        'FORMULA':formula,'OUTPUT':out})
 
-#Create a 1 km2 grid using the extent of input CT
-CT_Ext = layerCT.extent()
-ext = str(CT_Ext.xMinimum()) +','+ str(CT_Ext.xMaximum()) +','+ str(CT_Ext.yMinimum())+','+ str(CT_Ext.yMaximum())
-crs = '['+ layerCT.crs().authid() +']'
-processing.run("qgis:creategrid", 
-    {'TYPE':2,'EXTENT':ext+' '+crs,
-    'HSPACING':1000,'VSPACING':1000,'HOVERLAY':0,'VOVERLAY':0,
-    'CRS':QgsCoordinateReferenceSystem(layerCT.crs().authid()),'OUTPUT':TEMP+'\\GRID.shp'})
+###########################################
+#Load data and generate 1 km2 grid
+###########################################
 
-print("Loaded input data loaded and created 1 km2 grid")
+def createGrid():
+    #Create a 1 km2 grid using the extent of input CT
+    layer = QgsVectorLayer(CT, 'CensusTract', 'ogr')
+    CT_Ext = layer.extent()
+    ext = str(CT_Ext.xMinimum()) +','+ str(CT_Ext.xMaximum()) +','+ str(CT_Ext.yMinimum())+','+ str(CT_Ext.yMaximum())
+    crs = '['+ layer.crs().authid() +']'
+    run("qgis:creategrid", 
+        {'TYPE':2,'EXTENT':ext+' '+crs,
+        'HSPACING':1000,'VSPACING':1000,'HOVERLAY':0,'VOVERLAY':0,
+        'CRS':QgsCoordinateReferenceSystem(layer.crs().authid()),'OUTPUT':tmp('GRID')})
 
 ###########################################
 #Validate and preprocess the input data       
 ###########################################
 
-#Fix geometries of the input data files
-processing.run("native:fixgeometries", {'INPUT': BF,'OUTPUT': TEMP+'\\BF_fixed.shp'})
-processing.run("native:fixgeometries", {'INPUT': CT,'OUTPUT': TEMP+'\\CT_fixed.shp'})
-processing.run("native:fixgeometries", {'INPUT': DB,'OUTPUT': TEMP+'\\DB_fixed.shp'})
-
-#Clip BF to CT's extent
-processing.run("native:clip",{'INPUT':TEMP+'\\BF_fixed.shp','OVERLAY':TEMP+'\\CT_fixed.shp','OUTPUT':TEMP+'\\BF_clipped.shp'})
-
-#Add geometry attributes (area and perimeter) to CT, DB, and GRID
-processing.run("qgis:exportaddgeometrycolumns", {'INPUT':TEMP+'\\CT_fixed.shp','CALC_METHOD':0,'OUTPUT':TEMP+'\\CT_geom.shp'})
-processing.run("qgis:exportaddgeometrycolumns", {'INPUT':TEMP+'\\DB_fixed.shp','CALC_METHOD':0,'OUTPUT':TEMP+'\\DB_geom.shp'})
-processing.run("qgis:exportaddgeometrycolumns", {'INPUT':TEMP+'\\GRID.shp','CALC_METHOD':0,'OUTPUT':TEMP+'\\GRID_geom.shp'})
-
-#Drop unnecessary fields in the input data to speed up processing
-processing.run("qgis:deletecolumn", 
-    {'INPUT':TEMP+'\\BF_fixed.shp',
-    'COLUMN':['Longitude','Latitude','CSDUID','CSDNAME','Data_prov','Shape_Leng'],
-    'OUTPUT':TEMP+'\\BF_clean.shp'})
-
-processing.run("qgis:deletecolumn", 
-    {'INPUT':TEMP+'\\CT_geom.shp',
-    'COLUMN':['CTNAME','PRUID','CMAUID','CMAPUID','perimeter'],
-    'OUTPUT':TEMP+'\\CT_clean.shp'})
-
-processing.run("qgis:deletecolumn", 
-    {'INPUT':TEMP+'\\DB_geom.shp',
-    'COLUMN':['DBRPLAMX','DBRPLAMY','PRUID','CDUID','CDNAME','CDTYPE','CCSUID','CCSNAME','CSDUID','CSDNAME','CSDTYPE','ERUID','ERNAME','FEDUID','FEDNAME','SACCODE','SACTYPE','CMAUID','CMAPUID','CTUID','CTNAME','ADAUID','DAUID','perimeter'],
-    'OUTPUT':TEMP+'\\DB_clean.shp'})
-    
-processing.run("qgis:deletecolumn", 
-    {'INPUT':TEMP+'\\GRID_geom.shp',
-    'COLUMN':['left','top','right','bottom','perimeter'],
-    'OUTPUT':TEMP+'\\GRID_clean.shp'})
-print("Validated and preprocessed input data")
+def fixGeometries(inp, out):
+    run("native:fixgeometries", {'INPUT':inp,'OUTPUT':out})
+
+def clipBuildings():
+    #Clip BF to CT's extent
+    run("native:clip",{'INPUT':tmp('BF_fixed'),'OVERLAY':tmp('CT_fixed'),'OUTPUT':tmp('BF_clipped')})
+
+def addGeometry(inp, out):
+    #Add geometry attributes (area and perimeter)
+    run("qgis:exportaddgeometrycolumns", {'INPUT':inp,'CALC_METHOD':0,'OUTPUT':out})
+
+def deleteColumns(inp, columns, out):
+    #Drop unnecessary fields in the input data to speed up processing
+    run("qgis:deletecolumn", {'INPUT':inp,'COLUMN':columns,'OUTPUT':out})
 
 ###########################################
 #Edge distance between nearest buildings 
 ###########################################
-NNJoinLayer= iface.addVectorLayer(TEMP+'\\BF_clean.shp','NNJoinLayer','ogr')
 
-#Shortly after executing the code, the NNJoin window will pop out.
-#Make sure you have installed the plugin NNJoin in QGIS
-    #Plugins --> Manage and Install Plugins --> search for NNjoin and install
-#Prompt the user to set the parameters as follows
-print("--------------------------")
-print("In the NNJoin pop-out window, set the parameters as follows")
-print("Input vector layer:NNJoinLayer BF_clean")
-print("Join vector layer:NNJoinLayer BF_clean")
-print("Join prefix:nearest_")
-print("Output layer:BF_NNJoin")
-print("LEAVE ALL THE OTHER PARAMETERS AS DEFAULT")
-print("Click OK")
-print("--------------------------")
-print("The rest of the Python script will be automatically executed after NNJoin is completed.")
-
-import NNJoin
-#Run the following commands to identify what function we should run in this plugin
-    #help(NNJoin)
-from qgis.utils import plugins
-    #dir (plugins['NNJoin'])
-plugins['NNJoin'].run()
+def nnJoin():
+    NNJoinLayer= iface.addVectorLayer(tmp('BF_clean'),'NNJoinLayer','ogr')
+
+    #Shortly after executing the code, the NNJoin window will pop out.
+    #Make sure you have installed the plugin NNJoin in QGIS
+        #Plugins --> Manage and Install Plugins --> search for NNjoin and install
+    #Prompt the user to set the parameters as follows
+    print("--------------------------")
+    print("In the NNJoin pop-out window, set the parameters as follows")
+    print("Input vector layer:NNJoinLayer BF_clean")
+    print("Join vector layer:NNJoinLayer BF_clean")
+    print("Join prefix:nearest_")
+    print("Output layer:BF_NNJoin")
+    print("LEAVE ALL THE OTHER PARAMETERS AS DEFAULT")
+    print("Click OK")
+    print("--------------------------")
+    print("The rest of the Python script will be automatically executed after NNJoin is completed.")
+
+    import NNJoin
+    #Run the following commands to identify what function we should run in this plugin
+        #help(NNJoin)
+        #dir (plugins['NNJoin'])
+    plugins['NNJoin'].run()
+
+    #Save the result layer to shapefile
+    NNJoin_Result = QgsProject.instance().mapLayersByName("BF_NNJoin")[0]
+    QgsVectorFileWriter.writeAsVectorFormat(NNJoin_Result, tmp('BF_NNJoin'), "utf-8", NNJoin_Result.crs(), "ESRI Shapefile")
+
+    #Remove layers
+    QgsProject.instance().layerTreeRoot().removeLayer(NNJoinLayer)
+    QgsProject.instance().layerTreeRoot().removeLayer(NNJoin_Result)
+
+def selectContiguous():
+    #Select distance <= 1m in BF_NNJoin.shp and save as a new shapefile
+    TempLayer = QgsVectorLayer(tmp('BF_NNJoin'), 'TempLayer', 'ogr')
+    TempLayer.selectByExpression('"distance" <= 1', QgsVectorLayer.SetSelection)
+    QgsVectorFileWriter.writeAsVectorFormat(
+        TempLayer, tmp('BF_NNJoin1m'), 'System', 
+        QgsCoordinateReferenceSystem(TempLayer.crs().authid()), 'ESRI Shapefile', onlySelected=True)
 
-#Save the result layer to shapefile
-NNJoin_Result = QgsProject.instance().mapLayersByName("BF_NNJoin")[0]
-QgsVectorFileWriter.writeAsVectorFormat(NNJoin_Result, TEMP+ "\\BF_NNJoin.shp", "utf-8", NNJoin_Result.crs(), "ESRI Shapefile")
+###########################################
+#Building statistics by CT, DB or GRID (Z)
+###########################################
 
-#Remove layers
-QgsProject.instance().layerTreeRoot().removeLayer(NNJoinLayer)
-QgsProject.instance().layerTreeRoot().removeLayer(NNJoin_Result)
+def averageSize(Z):
+    #Calculate average size (AvgSize)
+    summarize(tmp(Z+'_clean'), tmp('BF_clean'), 'Shape_Area', 6, True, tmp(Z+'_AvgSize'), 'AvgSize')
 
-print("Computed edge distance between nearest buildings")
+def buildingDensity(Z):
+    #Calculate building count and building density (BD)
+    summarize(tmp(Z+'_AvgSize'), tmp('BF_clean'), 'Build_ID', 0, False, tmp(Z+'_AvgSize_BldgCount'), 'BldgCount')
+    calculate(tmp(Z+'_AvgSize_BldgCount'), 'BD', 'BldgCount / area', tmp(Z+'_AvgSize_BD'))
 
-###########################################
-#Calculate average size (AvgSize)      
-###########################################
+def coverageRatio(Z):
+    #Calculate SumBldgArea and divide it by the area of the zone (BCR)
+    summarize(tmp(Z+'_AvgSize_BD'), tmp('BF_clean'), 'Shape_Area', 5, True, tmp(Z+'_SumBldgArea'), 'BldgArea')
+    calculate(tmp(Z+'_SumBldgArea'), 'BCR', 'BldgArea / area', tmp(Z+'_AvgSize_BD_BCR'))
 
-#CT_AvgSize.shp
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT':TEMP+'\\CT_clean.shp','JOIN':TEMP+'\\BF_clean.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['Shape_Area'],'SUMMARIES':[6],'DISCARD_NONMATCHING':True,
-    'OUTPUT':TEMP+'\\CT_AvgSize.shp'})
-#Load the output shapefile as a layer and rename the field
-    #renameAttribute(self, index: int, newName: str)
-    #and then remove TempLayer
-TempLayer= iface.addVectorLayer(TEMP+'\\CT_AvgSize.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())  #the index of the field to be renamed
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'AvgSize')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-
-#DB_AvgSize.shp
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT':TEMP+'\\DB_clean.shp','JOIN':TEMP+'\\BF_clean.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['Shape_Area'],'SUMMARIES':[6],'DISCARD_NONMATCHING':True,
-    'OUTPUT':TEMP+'\\DB_AvgSize.shp'})
-TempLayer= iface.addVectorLayer(TEMP+'\\DB_AvgSize.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'AvgSize')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-
-#GRID_AvgSize.shp
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT':TEMP+'\\GRID_clean.shp','JOIN':TEMP+'\\BF_clean.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['Shape_Area'],'SUMMARIES':[6],'DISCARD_NONMATCHING':True,
-    'OUTPUT':TEMP+'\\GRID_AvgSize.shp'})
-TempLayer= iface.addVectorLayer(TEMP+'\\GRID_AvgSize.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'AvgSize')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-
-print("Calculated average size (AvgSize)")
+def proximity(Z):
+    #Calculate building proximity (ProxMean)
+    summarize(tmp(Z+'_AvgSize_BD_BCR'), tmp('BF_NNJoin'), 'distance', 6, False, tmp(Z+'_AvgSize_BD_BCR_Prox'), 'ProxMean')
+
+def contiguity(Z):
+    #Count contiguous buildings (distance <= 1m) and calculate building contiguity (ContRatio)
+    summarize(tmp(Z+'_AvgSize_BD_BCR_Prox'), tmp('BF_NNJoin1m'), 'Build_ID', 0, False, tmp(Z+'_ContCount'), 'ContCount')
+    calculate(tmp(Z+'_ContCount'), 'ContRatio', 'ContCount / BldgCount', FO+'\\'+Z+'_Stats.shp')
 
 ###########################################
-#Calculate building density (BD)      
+#Area-weighted apportionment (APPORTION)
 ###########################################
 
-#Calculate building count by CT
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT':TEMP+'\\CT_AvgSize.shp','JOIN':TEMP+'\\BF_clean.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['Build_ID'],'SUMMARIES':[0],'DISCARD_NONMATCHING':False,
-    'OUTPUT':TEMP+'\\CT_AvgSize_BldgCount.shp'})
-#Rename the field
-TempLayer= iface.addVectorLayer(TEMP+'\\CT_AvgSize_BldgCount.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())  #the index of the field to be renamed
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'BldgCount')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-#Calculate BD by CT
-processing.run("qgis:fieldcalculator", 
-    {'INPUT':TEMP+'\\CT_AvgSize_BldgCount.shp',
-    'FIELD_NAME':'BD','FIELD_TYPE':0,'FIELD_LENGTH':12,'FIELD_PRECISION':8,'NEW_FIELD':True,'FORMULA':'BldgCount / area',
-    'OUTPUT':TEMP+'\\CT_AvgSize_BD.shp'})
-
-#Calculate building count by DB
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT':TEMP+'\\DB_AvgSize.shp','JOIN':TEMP+'\\BF_clean.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['Build_ID'],'SUMMARIES':[0],'DISCARD_NONMATCHING':False,
-    'OUTPUT':TEMP+'\\DB_AvgSize_BldgCount.shp'})
-#Rename the field
-TempLayer= iface.addVectorLayer(TEMP+'\\DB_AvgSize_BldgCount.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'BldgCount')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-#Calculate BD by DB
-processing.run("qgis:fieldcalculator", 
-    {'INPUT':TEMP+'\\DB_AvgSize_BldgCount.shp',
-    'FIELD_NAME':'BD','FIELD_TYPE':0,'FIELD_LENGTH':12,'FIELD_PRECISION':8,'NEW_FIELD':True,'FORMULA':'BldgCount / area',
-    'OUTPUT':TEMP+'\\DB_AvgSize_BD.shp'})
-    
-#Calculate building count by GRID
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT':TEMP+'\\GRID_AvgSize.shp','JOIN':TEMP+'\\BF_clean.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['Build_ID'],'SUMMARIES':[0],'DISCARD_NONMATCHING':False,
-    'OUTPUT':TEMP+'\\GRID_AvgSize_BldgCount.shp'})
-#Rename the field
-TempLayer= iface.addVectorLayer(TEMP+'\\GRID_AvgSize_BldgCount.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'BldgCount')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-#Calculate BD by GRID
-processing.run("qgis:fieldcalculator", 
-    {'INPUT':TEMP+'\\GRID_AvgSize_BldgCount.shp',
-    'FIELD_NAME':'BD','FIELD_TYPE':0,'FIELD_LENGTH':12,'FIELD_PRECISION':8,'NEW_FIELD':True,'FORMULA':'BldgCount / area',
-    'OUTPUT':TEMP+'\\GRID_AvgSize_BD.shp'})
-
-print("Calculated building density (BD)")
+def pairFractionsVectorized(zoneGeoms, bldgGeoms):
+    #Candidate (zone, building) pairs and the fraction of the building allocated to the zone,
+    #with every test run as a shapely array operation over all candidate pairs at once.
+    #Only buildings whose bounding box crosses a zone edge are intersected,
+    #every other pair is resolved with a point-in-polygon test.
+    zones = shapely.from_wkb([bytes(g.asWkb()) for g in zoneGeoms])
+    bldgs = shapely.from_wkb([bytes(g.asWkb()) for g in bldgGeoms])
+    boxes = shapely.box(*shapely.bounds(bldgs).T)
+    bldgIdx, zoneIdx = shapely.STRtree(zones).query(boxes)
+    edges = shapely.boundary(zones)
+    shapely.prepare(zones)
+    shapely.prepare(edges)
+    crossing = shapely.intersects(edges[zoneIdx], boxes[bldgIdx])
+    frac = np.zeros(len(bldgIdx))
+
+    #The building lies entirely inside or entirely outside the zone
+    inner = ~crossing
+    points = np.empty(len(bldgs), dtype=object)
+    needPoint = np.unique(bldgIdx[inner])
+    points[needPoint] = shapely.point_on_surface(bldgs[needPoint])
+    frac[inner] = shapely.intersects(zones[zoneIdx[inner]], points[bldgIdx[inner]])
+
+    #The building straddles the zone edge
+    area = shapely.area(bldgs)[bldgIdx[crossing]]
+    interArea = shapely.area(shapely.intersection(zones[zoneIdx[crossing]], bldgs[bldgIdx[crossing]]))
+    frac[crossing] = np.divide(interArea, area, out=np.zeros(len(area)), where=area > 0)
+
+    keep = frac > 0
+    return zoneIdx[keep], bldgIdx[keep], frac[keep]
+
+def pairFractionsLoop(zoneGeoms, bldgGeoms):
+    #Same as pairFractionsVectorized, one pair at a time with QGIS geometry engines.
+    #Used when shapely 2 is not available (QGIS builds that bundle shapely 1.x or no shapely).
+    index = QgsSpatialIndex()
+    for z, geom in enumerate(zoneGeoms):
+        index.addFeature(z, geom.boundingBox())
+    #Prepared geometry engines of the zone polygons and zone edges, built on first use.
+    #The engines keep a pointer to their geometry, so the zone edges are kept alive in zoneEdge.
+    polyEngine = {}
+    zoneEdge = {}
+    edgeEngine = {}
+    pairZone = []
+    pairBldg = []
+    pairFrac = []
+    for b, geom in enumerate(bldgGeoms):
+        bbox = geom.boundingBox()
+        bboxGeom = QgsGeometry.fromRect(bbox)
+        point = None
+        area = geom.area()
+        for z in index.intersects(bbox):
+            if z not in polyEngine:
+                polyEngine[z] = QgsGeometry.createGeometryEngine(zoneGeoms[z].constGet())
+                polyEngine[z].prepareGeometry()
+                zoneEdge[z] = QgsGeometry(zoneGeoms[z].constGet().boundary())
+                edgeEngine[z] = QgsGeometry.createGeometryEngine(zoneEdge[z].constGet())
+                edgeEngine[z].prepareGeometry()
+            if not edgeEngine[z].intersects(bboxGeom.constGet()):
+                #The building lies entirely inside or entirely outside this zone
+                if point is None:
+                    point = geom.pointOnSurface()
+                if not polyEngine[z].intersects(point.constGet()):
+                    continue
+                frac = 1.0
+            else:
+                #The building straddles the zone edge
+                if area <= 0:
+                    continue
+                inter = polyEngine[z].intersection(geom.constGet())
+                frac = inter.area() / area if inter is not None else 0
+                if frac <= 0:
+                    continue
+            pairZone.append(z)
+            pairBldg.append(b)
+            pairFrac.append(frac)
+    return np.array(pairZone, dtype=np.int64), np.array(pairBldg, dtype=np.int64), np.array(pairFrac, dtype=float)
+
+def apportionBuildings(zoneFile, idField, bldgFile, pairFile):
+    #Split each building among the zones it overlaps by intersection area and save the
+    #(zone, building) pairs with their fractions to pairFile (.npz).
+    #This stage does not need NNJoin, so it runs while NNJoin is open.
+    zoneLayer = QgsVectorLayer(zoneFile, 'ZoneLayer', 'ogr')
+    bldgLayer = QgsVectorLayer(bldgFile, 'BldgLayer', 'ogr')
+    zoneGeoms = []
+    zoneIds = []
+    for f in zoneLayer.getFeatures():
+        zoneGeoms.append(f.geometry())
+        zoneIds.append(f[idField])
+    bldgGeoms = []
+    bldgIds = []
+    bldgArea = []
+    for f in bldgLayer.getFeatures():
+        bldgGeoms.append(f.geometry())
+        bldgIds.append(f['Build_ID'])
+        bldgArea.append(f['Shape_Area'])
+    if HAS_SHAPELY2:
+        pairZone, pairBldg, pairFrac = pairFractionsVectorized(zoneGeoms, bldgGeoms)
+    else:
+        pairZone, pairBldg, pairFrac = pairFractionsLoop(zoneGeoms, bldgGeoms)
+    np.savez(pairFile, zoneIds=np.array(zoneIds), pairZone=pairZone, pairFrac=pairFrac,
+        pairBldgId=np.array(bldgIds)[pairBldg], pairArea=np.array(bldgArea, dtype=float)[pairBldg])
+
+def apportionStats(zoneFile, idField, pairFile, nnJoinFile, outFile):
+    #Attach the NNJoin distance to the pairs of apportionBuildings by Build_ID and
+    #write AvgSize, BldgCount, BD, BldgArea, BCR, ProxMean, ContCount and ContRatio to outFile.
+    zoneLayer = QgsVectorLayer(zoneFile, 'ZoneLayer', 'ogr')
+    nnJoinLayer = QgsVectorLayer(nnJoinFile, 'NNJoinLayer', 'ogr')
+    bldgDist = {}
+    for f in nnJoinLayer.getFeatures():
+        bldgDist[f['Build_ID']] = f['distance']
+    pairs = np.load(pairFile, allow_pickle=True)
+    zoneIds = pairs['zoneIds']
+    pairZone = pairs['pairZone']
+    pairFrac = pairs['pairFrac']
+    shapeArea = pairs['pairArea']
+    distance = np.array([bldgDist[bldgId] for bldgId in pairs['pairBldgId'].tolist()], dtype=float)
+
+    #Aggregate the fractional contributions by zone
+    n = len(zoneIds)
+    count = np.bincount(pairZone, weights=pairFrac, minlength=n)
+    sumArea = np.bincount(pairZone, weights=pairFrac * shapeArea, minlength=n)
+    sumDist = np.bincount(pairZone, weights=pairFrac * distance, minlength=n)
+    contCount = np.bincount(pairZone, weights=pairFrac * (distance <= 1), minlength=n)
+    #Statistics keyed by the zone ID, so that they do not depend on the feature order of outFile
+    stats = {}
+    for i, zoneId in enumerate(zoneIds.tolist()):
+        stats[zoneId] = (count[i], sumArea[i], sumDist[i], contCount[i])
+
+    #Copy the zones to outFile and add the statistics fields.
+    #Ratios fit in width 12, counts, areas and distances need a wider field.
+    QgsVectorFileWriter.writeAsVectorFormat(zoneLayer, outFile, "utf-8", zoneLayer.crs(), "ESRI Shapefile")
+    TempLayer = QgsVectorLayer(outFile, 'TempLayer', 'ogr')
+    names = ['AvgSize', 'BldgCount', 'BD', 'BldgArea', 'BCR', 'ProxMean', 'ContCount', 'ContRatio']
+    ratios = ['BD', 'BCR', 'ContRatio']
+    with edit(TempLayer):
+        for name in names:
+            TempLayer.addAttribute(QgsField(name, QVariant.Double, 'double', 12 if name in ratios else 20, 8))
+        TempLayer.updateFields()
+        idx = [TempLayer.fields().indexFromName(name) for name in names]
+        for f in TempLayer.getFeatures():
+            zoneCount, zoneArea, zoneDist, zoneCont = stats[f[idField]]
+            #Drop zones without buildings, as DISCARD_NONMATCHING does for AvgSize in the default mode
+            if zoneCount <= 0:
+                TempLayer.deleteFeature(f.id())
+                continue
+            values = [zoneArea / zoneCount, zoneCount, zoneCount / f['area'], zoneArea, zoneArea / f['area'],
+                zoneDist / zoneCount, zoneCont, zoneCont / zoneCount]
+            for j, value in zip(idx, values):
+                TempLayer.changeAttributeValue(f.id(), j, float(value))
 
 ###########################################
-#Calculate building coverage ratio (BCR)
+#Load the final outputs into QGIS  
 ###########################################
 
-#Calculate BCR by CT
-#Calculate SumBldgArea by CT
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT': TEMP+'\\CT_AvgSize_BD.shp','JOIN':TEMP+'\\BF_clean.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['Shape_Area'],'SUMMARIES':[5],'DISCARD_NONMATCHING':True,
-    'OUTPUT':TEMP+'\\CT_SumBldgArea.shp'})
-#Rename the field
-TempLayer= iface.addVectorLayer(TEMP+'\\CT_SumBldgArea.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'BldgArea')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-#Divide SumBldgArea by the area of CT
-processing.run("qgis:fieldcalculator", 
-    {'INPUT':TEMP+'\\CT_SumBldgArea.shp',
-    'FIELD_NAME':'BCR','FIELD_TYPE':0,'FIELD_LENGTH':12,'FIELD_PRECISION':8,'NEW_FIELD':True,'FORMULA':'BldgArea / area',
-    'OUTPUT':TEMP+'\\CT_AvgSize_BD_BCR.shp'})
-
-#Calculate BCR by DB
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT': TEMP+'\\DB_AvgSize_BD.shp','JOIN':TEMP+'\\BF_clean.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['Shape_Area'],'SUMMARIES':[5],'DISCARD_NONMATCHING':True,
-    'OUTPUT':TEMP+'\\DB_SumBldgArea.shp'})
-TempLayer= iface.addVectorLayer(TEMP+'\\DB_SumBldgArea.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'BldgArea')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-processing.run("qgis:fieldcalculator", 
-    {'INPUT':TEMP+'\\DB_SumBldgArea.shp',
-    'FIELD_NAME':'BCR','FIELD_TYPE':0,'FIELD_LENGTH':12,'FIELD_PRECISION':8,'NEW_FIELD':True,'FORMULA':'BldgArea / area',
-    'OUTPUT':TEMP+'\\DB_AvgSize_BD_BCR.shp'})
-
-#Calculate BCR by GRID
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT': TEMP+'\\GRID_AvgSize_BD.shp','JOIN':TEMP+'\\BF_clean.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['Shape_Area'],'SUMMARIES':[5],'DISCARD_NONMATCHING':True,
-    'OUTPUT':TEMP+'\\GRID_SumBldgArea.shp'})
-TempLayer= iface.addVectorLayer(TEMP+'\\GRID_SumBldgArea.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'BldgArea')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-processing.run("qgis:fieldcalculator", 
-    {'INPUT':TEMP+'\\GRID_SumBldgArea.shp',
-    'FIELD_NAME':'BCR','FIELD_TYPE':0,'FIELD_LENGTH':12,'FIELD_PRECISION':8,'NEW_FIELD':True,'FORMULA':'BldgArea / area',
-    'OUTPUT':TEMP+'\\GRID_AvgSize_BD_BCR.shp'})
-
-print("Calculated building coverage ratio (BCR)")
+def loadOutputs():
+    iface.addVectorLayer(FO+'\\CT_Stats.shp','','ogr')
+    iface.addVectorLayer(FO+'\\DB_Stats.shp','','ogr')
+    iface.addVectorLayer(FO+'\\GRID_Stats.shp','','ogr')
 
 ###########################################
-#Calculate building proximity (ProxMean)      
+#Stage scheduler
 ###########################################
 
-#Calculate ProxMean by CT
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT':TEMP+'\\CT_AvgSize_BD_BCR.shp','JOIN':TEMP+'\\BF_NNJoin.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['distance'],'SUMMARIES':[6],'DISCARD_NONMATCHING':False,
-    'OUTPUT':TEMP+'\\CT_AvgSize_BD_BCR_Prox.shp'})
-#Rename the field
-TempLayer= iface.addVectorLayer(TEMP+'\\CT_AvgSize_BD_BCR_Prox.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'ProxMean')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-
-#Calculate ProxMean by DB
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT':TEMP+'\\DB_AvgSize_BD_BCR.shp','JOIN':TEMP+'\\BF_NNJoin.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['distance'],'SUMMARIES':[6],'DISCARD_NONMATCHING':False,
-    'OUTPUT':TEMP+'\\DB_AvgSize_BD_BCR_Prox.shp'})
-TempLayer= iface.addVectorLayer(TEMP+'\\DB_AvgSize_BD_BCR_Prox.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'ProxMean')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-
-#Calculate ProxMean by GRID
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT':TEMP+'\\GRID_AvgSize_BD_BCR.shp','JOIN':TEMP+'\\BF_NNJoin.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['distance'],'SUMMARIES':[6],'DISCARD_NONMATCHING':False,
-    'OUTPUT':TEMP+'\\GRID_AvgSize_BD_BCR_Prox.shp'})
-TempLayer= iface.addVectorLayer(TEMP+'\\GRID_AvgSize_BD_BCR_Prox.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'ProxMean')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-
-print("Calculated building proximity (ProxMean)")
+def inputSignature():
+    #Input files (path, modification time and size) and mode of the current run.
+    #The attributes are in the .dbf, so every file of each input shapefile is included.
+    lines = ['APPORTION ' + str(APPORTION)]
+    for path in [BF, CT, DB]:
+        for ext in ['.shp', '.dbf', '.shx', '.prj', '.cpg']:
+            part = os.path.splitext(path)[0] + ext
+            if os.path.exists(part):
+                lines.append('input ' + part + ' ' + str(os.path.getmtime(part)) + ' ' + str(os.path.getsize(part)))
+            else:
+                lines.append('input ' + part + ' missing')
+    return lines
+
+def runStages(stages, workers, checkpoint, signature, resume):
+    #Run the stages as a DAG: a stage depends on the stages producing its inputs.
+    #Stages with main=True use iface and run on the main thread, all others run on a pool of workers.
+    #With workers == 1 every stage runs on the main thread, one after another.
+    #checkpoint starts with the signature lines (prefixed with #), followed by the name of every completed stage.
+    producer = {}
+    for stage in stages:
+        for out in stage['outputs']:
+            producer[out] = stage['name']
+    deps = {}
+    for stage in stages:
+        deps[stage['name']] = {producer[inp] for inp in stage['inputs'] if inp in producer}
+
+    #A recorded stage counts as completed if it has outputs, they exist and its upstream stages are completed
+    done = set()
+    if resume and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            lines = [line.rstrip('\n') for line in f]
+        recorded = {line for line in lines if not line.startswith('#')}
+        if [line[1:] for line in lines if line.startswith('#')] != signature:
+            print("Input data or APPORTION changed since the last run, running all stages")
+            recorded = set()
+        done = {s['name'] for s in stages
+            if s['name'] in recorded and s['outputs'] and all(os.path.exists(out) for out in s['outputs'])}
+        stale = {name for name in done if not deps[name] <= done}
+        while stale:
+            done -= stale
+            stale = {name for name in done if not deps[name] <= done}
+    with open(checkpoint, 'w') as f:
+        for line in signature:
+            f.write('#' + line + '\n')
+        for stage in stages:
+            if stage['name'] in done:
+                f.write(stage['name'] + '\n')
+    for stage in stages:
+        if stage['name'] in done:
+            print("Skipped completed stage " + stage['name'])
+
+    pending = [stage for stage in stages if stage['name'] not in done]
+    #Finished worker stages start their successors from their done-callbacks, so a stage
+    #running on the main thread (e.g. the NNJoin dialog) does not hold up the worker stages.
+    #Main thread stages and messages are passed to the main thread through mainQueue.
+    lock = threading.RLock()
+    mainQueue = queue.Queue()
+    state = {'running':0, 'failure':None}
+
+    def startReady():
+        #Start every pending stage whose upstream stages are completed (call with lock held)
+        ready = []
+        if state['failure'] is None:
+            ready = [stage for stage in pending if deps[stage['name']] <= done]
+        for stage in ready:
+            pending.remove(stage)
+        state['running'] += len(ready)
+        for stage in ready:
+            if stage['main'] or workers == 1:
+                mainQueue.put(('run', stage))
+            else:
+                future = pool.submit(stage['func'], *stage['args'])
+                future.add_done_callback(lambda future, stage=stage: complete(stage, future.exception()))
+        if state['running'] == 0:
+            mainQueue.put(('end', None))
+
+    def complete(stage, error):
+        #Record a finished stage and start the stages waiting for it
+        with lock:
+            state['running'] -= 1
+            if error is None:
+                done.add(stage['name'])
+                with open(checkpoint, 'a') as f:
+                    f.write(stage['name'] + '\n')
+                mainQueue.put(('print', "Completed stage " + stage['name']))
+            else:
+                state['failure'] = state['failure'] or error
+                mainQueue.put(('print', "Failed stage " + stage['name'] + ": " + str(error)))
+            startReady()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        with lock:
+            startReady()
+        while True:
+            kind, item = mainQueue.get()
+            if kind == 'print':
+                print(item)
+            elif kind == 'run':
+                error = None
+                try:
+                    item['func'](*item['args'])
+                except Exception as e:
+                    error = e
+                complete(item, error)
+            else:
+                break
+    if state['failure'] is not None:
+        raise state['failure']
+    if pending:
+        raise RuntimeError("Stages with unmet inputs: " + ', '.join(stage['name'] for stage in pending))
+
+def stage(name, inputs, outputs, func, *args, main=False):
+    STAGES.append({'name':name,'inputs':inputs,'outputs':outputs,'func':func,'args':args,'main':main})
 
 ###########################################
-#Calculate building contiguity (ContRatio)    
+#Declare the stages
 ###########################################
-
-#Select distance <= 1m in BF_NNJoin.shp and save as a new shapefile
-TempLayer= iface.addVectorLayer(TEMP+'\\BF_NNJoin.shp','TempLayer','ogr')
-TempLayer.selectByExpression('"distance" <= 1', QgsVectorLayer.SetSelection)
-QgsVectorFileWriter.writeAsVectorFormat(
-    TempLayer, TEMP+'\\BF_NNJoin1m.shp', 'System', 
-    QgsCoordinateReferenceSystem(TempLayer.crs().authid()), 'ESRI Shapefile', onlySelected=True)
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-
-#Calculate ContRatio by CT
-#Count contiguous buildings (distance <= 1m) by CT
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT':TEMP+'\\CT_AvgSize_BD_BCR_Prox.shp','JOIN':TEMP+'\\BF_NNJoin1m.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['Build_ID'],'SUMMARIES':[0],'DISCARD_NONMATCHING':False,
-    'OUTPUT':TEMP+'\\CT_ContCount.shp'})
-#Rename the field
-TempLayer= iface.addVectorLayer(TEMP+'\\CT_ContCount.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'ContCount')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-#Calculate ContRatio by CT
-processing.run("qgis:fieldcalculator", 
-    {'INPUT':TEMP+'\\CT_ContCount.shp',
-    'FIELD_NAME':'ContRatio','FIELD_TYPE':0,'FIELD_LENGTH':12,'FIELD_PRECISION':8,'NEW_FIELD':True,
-    'FORMULA':'ContCount / BldgCount', 'OUTPUT':FO+'\\CT_Stats.shp'})
-
-#Calculate ContRatio by DB
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT':TEMP+'\\DB_AvgSize_BD_BCR_Prox.shp','JOIN':TEMP+'\\BF_NNJoin1m.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['Build_ID'],'SUMMARIES':[0],'DISCARD_NONMATCHING':False,
-    'OUTPUT':TEMP+'\\DB_ContCount.shp'})
-TempLayer= iface.addVectorLayer(TEMP+'\\DB_ContCount.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'ContCount')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-processing.run("qgis:fieldcalculator", 
-    {'INPUT':TEMP+'\\DB_ContCount.shp',
-    'FIELD_NAME':'ContRatio','FIELD_TYPE':0,'FIELD_LENGTH':12,'FIELD_PRECISION':8,'NEW_FIELD':True,
-    'FORMULA':'ContCount / BldgCount', 'OUTPUT':FO+'\\DB_Stats.shp'})
-    
-#Calculate ContRatio by GRID
-processing.run("qgis:joinbylocationsummary", 
-    {'INPUT':TEMP+'\\GRID_AvgSize_BD_BCR_Prox.shp','JOIN':TEMP+'\\BF_NNJoin1m.shp',
-    'PREDICATE':[1],'JOIN_FIELDS':['Build_ID'],'SUMMARIES':[0],'DISCARD_NONMATCHING':False,
-    'OUTPUT':TEMP+'\\GRID_ContCount.shp'})
-TempLayer= iface.addVectorLayer(TEMP+'\\GRID_ContCount.shp','TempLayer','ogr')
-idx = max(TempLayer.attributeList())
-with edit(TempLayer):
-    TempLayer.renameAttribute(idx, 'ContCount')
-QgsProject.instance().layerTreeRoot().removeLayer(TempLayer)
-processing.run("qgis:fieldcalculator", 
-    {'INPUT':TEMP+'\\GRID_ContCount.shp',
-    'FIELD_NAME':'ContRatio','FIELD_TYPE':0,'FIELD_LENGTH':12,'FIELD_PRECISION':8,'NEW_FIELD':True,
-    'FORMULA':'ContCount / BldgCount', 'OUTPUT':FO+'\\GRID_Stats.shp'})
-
-print("Calculated building contiguity (Contiguity)")
+STAGES = []
+
+stage('GRID', [CT], [tmp('GRID')], createGrid)
+stage('BF_fixed', [BF], [tmp('BF_fixed')], fixGeometries, BF, tmp('BF_fixed'))
+stage('CT_fixed', [CT], [tmp('CT_fixed')], fixGeometries, CT, tmp('CT_fixed'))
+stage('DB_fixed', [DB], [tmp('DB_fixed')], fixGeometries, DB, tmp('DB_fixed'))
+stage('BF_clipped', [tmp('BF_fixed'), tmp('CT_fixed')], [tmp('BF_clipped')], clipBuildings)
+stage('CT_geom', [tmp('CT_fixed')], [tmp('CT_geom')], addGeometry, tmp('CT_fixed'), tmp('CT_geom'))
+stage('DB_geom', [tmp('DB_fixed')], [tmp('DB_geom')], addGeometry, tmp('DB_fixed'), tmp('DB_geom'))
+stage('GRID_geom', [tmp('GRID')], [tmp('GRID_geom')], addGeometry, tmp('GRID'), tmp('GRID_geom'))
+stage('BF_clean', [tmp('BF_fixed')], [tmp('BF_clean')], deleteColumns, tmp('BF_fixed'),
+    ['Longitude','Latitude','CSDUID','CSDNAME','Data_prov','Shape_Leng'], tmp('BF_clean'))
+stage('CT_clean', [tmp('CT_geom')], [tmp('CT_clean')], deleteColumns, tmp('CT_geom'),
+    ['CTNAME','PRUID','CMAUID','CMAPUID','perimeter'], tmp('CT_clean'))
+stage('DB_clean', [tmp('DB_geom')], [tmp('DB_clean')], deleteColumns, tmp('DB_geom'),
+    ['DBRPLAMX','DBRPLAMY','PRUID','CDUID','CDNAME','CDTYPE','CCSUID','CCSNAME','CSDUID','CSDNAME','CSDTYPE','ERUID','ERNAME','FEDUID','FEDNAME','SACCODE','SACTYPE','CMAUID','CMAPUID','CTUID','CTNAME','ADAUID','DAUID','perimeter'],
+    tmp('DB_clean'))
+stage('GRID_clean', [tmp('GRID_geom')], [tmp('GRID_clean')], deleteColumns, tmp('GRID_geom'),
+    ['left','top','right','bottom','perimeter'], tmp('GRID_clean'))
+stage('BF_NNJoin', [tmp('BF_clean')], [tmp('BF_NNJoin')], nnJoin, main=True)
+
+#ID field of each zone layer, used to match the apportioned statistics to the output zones
+ZONE_ID = {'CT':'CTUID', 'DB':'DBUID', 'GRID':'id'}
+
+for Z in ['CT', 'DB', 'GRID']:
+    if APPORTION:
+        pairFile = TEMP+'\\'+Z+'_Pairs.npz'
+        stage(Z+'_Pairs', [tmp(Z+'_clean'), tmp('BF_clean')], [pairFile],
+            apportionBuildings, tmp(Z+'_clean'), ZONE_ID[Z], tmp('BF_clean'), pairFile)
+        stage(Z+'_Apportion', [tmp(Z+'_clean'), pairFile, tmp('BF_NNJoin')], [FO+'\\'+Z+'_Stats.shp'],
+            apportionStats, tmp(Z+'_clean'), ZONE_ID[Z], pairFile, tmp('BF_NNJoin'), FO+'\\'+Z+'_Stats.shp')
+    else:
+        stage(Z+'_AvgSize', [tmp(Z+'_clean'), tmp('BF_clean')], [tmp(Z+'_AvgSize')], averageSize, Z)
+        stage(Z+'_BD', [tmp(Z+'_AvgSize'), tmp('BF_clean')],
+            [tmp(Z+'_AvgSize_BldgCount'), tmp(Z+'_AvgSize_BD')], buildingDensity, Z)
+        stage(Z+'_BCR', [tmp(Z+'_AvgSize_BD'), tmp('BF_clean')],
+            [tmp(Z+'_SumBldgArea'), tmp(Z+'_AvgSize_BD_BCR')], coverageRatio, Z)
+        stage(Z+'_ProxMean', [tmp(Z+'_AvgSize_BD_BCR'), tmp('BF_NNJoin')], [tmp(Z+'_AvgSize_BD_BCR_Prox')], proximity, Z)
+        stage(Z+'_ContRatio', [tmp(Z+'_AvgSize_BD_BCR_Prox'), tmp('BF_NNJoin1m')],
+            [tmp(Z+'_ContCount'), FO+'\\'+Z+'_Stats.shp'], contiguity, Z)
+if not APPORTION:
+    stage('BF_NNJoin1m', [tmp('BF_NNJoin')], [tmp('BF_NNJoin1m')], selectContiguous)
+
+stage('Load', [FO+'\\CT_Stats.shp', FO+'\\DB_Stats.shp', FO+'\\GRID_Stats.shp'], [], loadOutputs, main=True)
 
 ###########################################
-#Load the final outputs into QGIS  
+#Run the stages
 ###########################################
-iface.addVectorLayer(FO+'\\CT_Stats.shp','','ogr')
-iface.addVectorLayer(FO+'\\DB_Stats.shp','','ogr')
-iface.addVectorLayer(FO+'\\GRID_Stats.shp','','ogr')
+#Remove all current layers
+QgsProject.instance().clear()
+
+#Open and display a vector layer
+    #iface.addVectorLayer(data_source, layer_name, provider_name)
+layerCT = iface.addVectorLayer(CT, 'CensusTract','ogr')
+layerDB = iface.addVectorLayer(DB, 'DissemninationBlock','ogr')
+layerBF = iface.addVectorLayer(BF, 'BuildingFootprints','ogr')
+
+runStages(STAGES, WORKERS, TEMP+'\\GeoUnitStats_stages.txt', inputSignature(), RESUME)
 print("All completed.")
\ No newline at end of file